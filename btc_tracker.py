@@ -4,117 +4,532 @@ import json
 import time
 import hmac
 import hashlib
+import http.client
+import threading
+import urllib.error
 import urllib.request
+from urllib.parse import quote, unquote, urlencode, urlsplit
 import argparse
 import base64
-import getpass
+import ssl
+import tempfile
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
 
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.backends import default_backend
-from cryptography.fernet import Fernet
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_FILE = os.path.join(SCRIPT_DIR, "config.enc")
 EUR_RATE = 0.92
+SATOSHIS_PER_BTC = 100_000_000
+HTTP_TIMEOUT = 10
+USER_AGENT = "btc-tracker"
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "btc_tracker")
+PRICE_CACHE_FILE = os.path.join(CACHE_DIR, "price.json")
+# CoinGecko only refreshes /simple/price every 20-30 seconds.
+PRICE_CACHE_TTL = 25
+
+COINGECKO_PRICE_PATH = "/api/v3/simple/price?" + urlencode(
+    {"ids": "bitcoin", "vs_currencies": "usd,eur"}
+)
+CONFIRMATIONS_QUERY = urlencode({"confirmations": 6})
+BALANCE_CACHE_FILE = os.path.join(CACHE_DIR, "balances.json")
+BATCH_SPLIT_WORKERS = 4
+
+KDF_PBKDF2 = 0
+KDF_ARGON2ID = 1
+
+# config.enc layout: format id (1 byte) + salt (16 bytes) + 12-byte nonce +
+# AES-256-GCM ciphertext. Files written before the format id existed start
+# directly with the salt, followed by a Fernet token, and always use PBKDF2.
+# Argon2id needs the optional argon2-cffi package; without it new configs
+# use PBKDF2.
+FORMAT_PBKDF2_FERNET = 0
+FORMAT_PBKDF2_AESGCM = 1
+FORMAT_ARGON2ID_AESGCM = 2
+FERNET_TOKEN_PREFIX = b"gAAAAA"
 
 
 # =====================================================
 #                ENCRYPTION HELPERS
 # =====================================================
 
-def derive_key(password: str, salt: bytes) -> bytes:
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=salt,
-        iterations=390000,
-        backend=default_backend()
+# Writes to an owner-only temporary file next to the target and renames it
+# into place, so a crash or a full disk never leaves a truncated file behind.
+def write_private_file(path: str, payload: bytes):
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}."
     )
-    return base64.urlsafe_b64encode(kdf.derive(password.encode()))
+    try:
+        try:
+            if hasattr(os, "fchmod"):
+                os.fchmod(fd, 0o600)
+            view = memoryview(payload)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def derive_key(password: str, salt: bytes, kdf: int = KDF_PBKDF2) -> bytes:
+    if kdf == KDF_PBKDF2:
+        dk = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, 390000, 32)
+    elif kdf == KDF_ARGON2ID:
+        from argon2.low_level import Type, hash_secret_raw
+
+        # 64 MiB split over 4 lanes, which libargon2 fills on separate
+        # threads; the memory cost per guess is the same for an attacker.
+        dk = hash_secret_raw(
+            password.encode(),
+            salt,
+            time_cost=2,
+            memory_cost=64 * 1024,
+            parallelism=4,
+            hash_len=32,
+            type=Type.ID
+        )
+    else:
+        raise ValueError(f"Unknown KDF id: {kdf}")
+    return dk
 
 
 def encrypt_config(data: dict, password: str):
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    try:
+        import argon2  # noqa: F401
+        fmt, kdf = FORMAT_ARGON2ID_AESGCM, KDF_ARGON2ID
+    except ImportError:
+        fmt, kdf = FORMAT_PBKDF2_AESGCM, KDF_PBKDF2
+
     salt = os.urandom(16)
-    key = derive_key(password, salt)
-    f = Fernet(key)
-    encrypted = f.encrypt(json.dumps(data).encode())
+    header = bytes([fmt]) + salt
+    key = derive_key(password, salt, kdf)
+    nonce = os.urandom(12)
+    encrypted = AESGCM(key).encrypt(
+        nonce, json_dumps(data), header
+    )
 
-    with open(CONFIG_FILE, "wb") as f_out:
-        f_out.write(salt + encrypted)
+    write_private_file(CONFIG_FILE, header + nonce + encrypted)
 
 
 def decrypt_config(password: str) -> dict:
     with open(CONFIG_FILE, "rb") as f:
         raw = f.read()
 
+    if raw[16:22] == FERNET_TOKEN_PREFIX:
+        fmt, header, raw = FORMAT_PBKDF2_FERNET, b"", raw
+    else:
+        fmt, header, raw = raw[0], raw[:17], raw[1:]
+
     salt = raw[:16]
     encrypted = raw[16:]
 
-    key = derive_key(password, salt)
-    fernet = Fernet(key)
-    decrypted = fernet.decrypt(encrypted)
+    if fmt in (FORMAT_PBKDF2_AESGCM, FORMAT_ARGON2ID_AESGCM):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        kdf = KDF_ARGON2ID if fmt == FORMAT_ARGON2ID_AESGCM else KDF_PBKDF2
+        key = derive_key(password, salt, kdf)
+        decrypted = AESGCM(key).decrypt(
+            encrypted[:12], encrypted[12:], header
+        )
+    elif fmt == FORMAT_PBKDF2_FERNET:
+        from cryptography.fernet import Fernet
+
+        # Fernet expects its key urlsafe-base64 encoded.
+        key = derive_key(password, salt, KDF_PBKDF2)
+        fernet = Fernet(base64.urlsafe_b64encode(key))
+        decrypted = fernet.decrypt(encrypted)
+    else:
+        raise ValueError(f"Unknown config format: {fmt}")
+
+    return json_loads(decrypted)
+
 
-    return json.loads(decrypted.decode())
+# PBKDF2 and the Binance HMAC signatures only get OpenSSL's assembly SHA-256
+# (SHA-NI / ARMv8 crypto extensions) through hashlib's OpenSSL backend, and
+# only OpenSSL >= 1.1.1 routes HMAC through EVP.
+def check_crypto_backend():
+    if getattr(hashlib.sha256, "__module__", None) != "_hashlib":
+        print("Warning: hashlib is not using OpenSSL; "
+              "key derivation and request signing will be slow.")
+    elif ssl.OPENSSL_VERSION_INFO < (1, 1, 1):
+        print(f"Warning: {ssl.OPENSSL_VERSION} is older than 1.1.1; "
+              "key derivation and request signing will be slow.")
+
+
+# =====================================================
+#                HTTP
+# =====================================================
+
+# Idle keep-alive connections per host, shared by all worker threads so
+# repeated requests to the same API skip the TCP and TLS handshakes.
+_idle_connections = {}
+_idle_lock = threading.Lock()
+
+
+# Errors raised on worker threads are queued and printed by main() between
+# output sections, so they never land in the middle of one.
+_worker_errors = []
+_worker_errors_lock = threading.Lock()
+
+
+def report_error(message: str):
+    if threading.current_thread() is threading.main_thread():
+        print(message)
+        return
+    with _worker_errors_lock:
+        _worker_errors.append(message)
+
+
+def flush_errors():
+    with _worker_errors_lock:
+        messages = _worker_errors[:]
+        _worker_errors.clear()
+    for message in messages:
+        print(message)
+
+
+def open_https_connection(host: str) -> http.client.HTTPSConnection:
+    # Honour HTTPS_PROXY / NO_PROXY the way urllib's ProxyHandler did, by
+    # tunnelling through the proxy with CONNECT.
+    proxy = urllib.request.getproxies().get("https")
+    if not proxy or urllib.request.proxy_bypass(host):
+        return http.client.HTTPSConnection(host, timeout=HTTP_TIMEOUT)
+
+    proxy = urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+    tunnel_headers = {}
+    if proxy.username:
+        credentials = f"{unquote(proxy.username)}:{unquote(proxy.password or '')}"
+        tunnel_headers["Proxy-Authorization"] = (
+            "Basic " + base64.b64encode(credentials.encode()).decode()
+        )
+
+    conn = http.client.HTTPSConnection(
+        proxy.hostname, proxy.port or 80, timeout=HTTP_TIMEOUT
+    )
+    conn.set_tunnel(host, 443, headers=tunnel_headers)
+    return conn
+
+
+# Redirects are not followed; none of the APIs used here redirect.
+def http_request(host: str, path: str, headers: dict = None,
+                 method: str = "GET", body: bytes = None) -> bytes:
+    headers = {"User-Agent": USER_AGENT, **(headers or {})}
+
+    while True:
+        with _idle_lock:
+            idle = _idle_connections.get(host)
+            conn = idle.pop() if idle else None
+        reused = conn is not None
+        if conn is None:
+            conn = open_https_connection(host)
+
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            r = conn.getresponse()
+            data = r.read()
+        except Exception as e:
+            conn.close()
+            # The server may have dropped a connection that sat idle in the
+            # pool; retry once on a fresh one.
+            if reused and isinstance(e, (http.client.HTTPException, ConnectionError)):
+                continue
+            raise
+
+        with _idle_lock:
+            _idle_connections.setdefault(host, []).append(conn)
+
+        if r.status >= 400:
+            raise urllib.error.HTTPError(
+                f"https://{host}{path}", r.status, r.reason, r.headers, None
+            )
+        return data
 
 
 # =====================================================
 #                PRICE FETCHING
 # =====================================================
 
-def fetch_btc_price():
-    url = "https://api.coingecko.com/api/v3/simple/price?ids=bitcoin&vs_currencies=usd,eur"
+_price_cache = {"t": 0.0, "v": (None, None)}
+
+
+def load_cached_price():
     try:
-        with urllib.request.urlopen(url, timeout=10) as r:
-            data = json.loads(r.read().decode())
-            return data["bitcoin"]["usd"], data["bitcoin"]["eur"]
-    except Exception as e:
-        print(f"Error fetching price: {e}")
-        return None, None
+        with open(PRICE_CACHE_FILE) as f:
+            cached = json.load(f)
+        if time.time() - cached["fetched_at"] < PRICE_CACHE_TTL:
+            return cached["usd"], cached["eur"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None, None
+
+
+def save_cached_price(usd, eur):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(PRICE_CACHE_FILE, "w") as f:
+            json.dump({"fetched_at": time.time(), "usd": usd, "eur": eur}, f)
+    except OSError:
+        pass
+
+
+def fetch_btc_price():
+    if (time.monotonic() - _price_cache["t"] < PRICE_CACHE_TTL
+            and _price_cache["v"][0] is not None):
+        return _price_cache["v"]
+
+    usd, eur = load_cached_price()
+    if usd is None:
+        try:
+            data = json_loads(http_request("api.coingecko.com", COINGECKO_PRICE_PATH))
+            usd, eur = data["bitcoin"]["usd"], data["bitcoin"]["eur"]
+        except Exception as e:
+            report_error(f"Error fetching price: {e}")
+            return None, None
+        save_cached_price(usd, eur)
+
+    _price_cache["t"] = time.monotonic()
+    _price_cache["v"] = (usd, eur)
+    return usd, eur
 
 
 # =====================================================
 #                BTC BALANCES
 # =====================================================
 
+# The fetchers below return None for addresses whose balance could not be
+# retrieved, so failures are never written to the balance cache.
+
 def fetch_btc_address_balance(address):
-    url = f"https://blockchain.info/q/addressbalance/{address}?confirmations=6"
+    path = f"/q/addressbalance/{quote(address, safe='')}?{CONFIRMATIONS_QUERY}"
     try:
-        with urllib.request.urlopen(url, timeout=10) as r:
-            satoshis = int(r.read().decode())
-            return satoshis / 1e8
+        return int(http_request("blockchain.info", path))
     except Exception as e:
-        print(f"Error fetching balance for {address}: {e}")
-        return 0.0
+        report_error(f"Error fetching balance for {address}: {e}")
+        return None
+
+
+def fetch_btc_address_batch(addresses):
+    if len(addresses) == 1:
+        return {addresses[0]: fetch_btc_address_balance(addresses[0])}
+
+    path = "/balance?" + urlencode({"active": "|".join(addresses), "confirmations": 6})
+    data = json_loads(http_request("blockchain.info", path))
+    return {addr: data[addr]["final_balance"] for addr in addresses}
+
+
+def fetch_btc_address_balances(addresses):
+    if not addresses:
+        return {}
+
+    balances = {}
+    pending = [addresses]
+    failed = None
+
+    # blockchain.info answers 400 when any address in a batch is invalid.
+    # Split such batches in half, level by level, so valid addresses stay
+    # batched and only the rejected ones end up on their own. Any other
+    # error (e.g. 429 rate limiting) fails the remaining batches instead of
+    # sending more requests to the same host.
+    with ThreadPoolExecutor(max_workers=BATCH_SPLIT_WORKERS) as pool:
+        while pending:
+            if failed is not None:
+                for part in pending:
+                    balances.update(dict.fromkeys(part))
+                break
+
+            futures = [(part, pool.submit(fetch_btc_address_batch, part))
+                       for part in pending]
+            pending = []
+            for part, future in futures:
+                try:
+                    balances.update(future.result())
+                except Exception as e:
+                    if isinstance(e, urllib.error.HTTPError) and e.code == 400:
+                        mid = len(part) // 2
+                        pending += [part[:mid], part[mid:]]
+                        continue
+                    if failed is None:
+                        failed = e
+                        report_error(f"Error fetching address balances: {e}")
+                    balances.update(dict.fromkeys(part))
+
+    return balances
+
+
+def fetch_block_height():
+    try:
+        return int(http_request("blockchain.info", "/q/getblockcount"))
+    except Exception as e:
+        report_error(f"Error fetching block height: {e}")
+        return None
 
 
-def fetch_binance_spot_balance(api_key, api_secret):
-    base = "https://api.binance.com"
-    endpoint = "/api/v3/account"
+# The balance cache never stores addresses in the clear: entries are keyed by
+# an HMAC of the address under a key derived from the (encrypted) config.
+def balance_cache_key(config):
+    h = hashlib.sha256(b"btc-tracker balance cache")
+    for part in (config["binance_api_key"], config["binance_api_secret"],
+                 *sorted(config["btc_addresses"])):
+        h.update(part.encode() + b"\0")
+    return h.digest()
 
-    ts = int(time.time() * 1000)
-    query = f"timestamp={ts}"
 
-    signature = hmac.new(
-        api_secret.encode(),
-        query.encode(),
-        hashlib.sha256
-    ).hexdigest()
+def load_balance_cache():
+    try:
+        with open(BALANCE_CACHE_FILE, "rb") as f:
+            cache = json_loads(f.read())
+        return cache if isinstance(cache, dict) else {}
+    except (OSError, ValueError):
+        return {}
 
-    url = f"{base}{endpoint}?{query}&signature={signature}"
-    req = urllib.request.Request(url)
-    req.add_header("X-MBX-APIKEY", api_key)
 
+def save_balance_cache(cache):
     try:
-        with urllib.request.urlopen(req, timeout=10) as r:
-            data = json.loads(r.read().decode())
-            for asset in data["balances"]:
-                if asset["asset"] == "BTC":
-                    return float(asset["free"]) + float(asset["locked"])
-            return 0.0
-    except Exception as e:
-        print(f"Error fetching Binance balance: {e}")
-        return 0.0
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        write_private_file(BALANCE_CACHE_FILE, json_dumps(cache))
+    except OSError:
+        pass
+
+
+def fetch_cached_btc_address_balances(addresses, cache_key):
+    if not addresses:
+        return {}
+
+    # A balance with 6 confirmations can only change once a new block is
+    # mined, so cached balances recorded at the current tip are still valid.
+    tip_height = fetch_block_height()
+    cache = load_balance_cache()
+    keys = {
+        addr: hmac.new(cache_key, addr.encode(), hashlib.sha256).hexdigest()
+        for addr in addresses
+    }
+
+    balances = {}
+    stale = []
+    for addr in addresses:
+        entry = cache.get(keys[addr])
+        if (tip_height is not None and isinstance(entry, dict)
+                and entry.get("tip_height") == tip_height
+                and "satoshis" in entry):
+            balances[addr] = entry["satoshis"]
+        else:
+            stale.append(addr)
+
+    if stale:
+        fetched = fetch_btc_address_balances(stale)
+        balances.update(fetched)
+
+        if tip_height is not None:
+            for addr, sats in fetched.items():
+                if sats is not None:
+                    cache[keys[addr]] = {
+                        "satoshis": sats,
+                        "tip_height": tip_height
+                    }
+            save_balance_cache({
+                key: cache[key] for key in keys.values() if key in cache
+            })
+
+    return {addr: sats or 0 for addr, sats in balances.items()}
+
+
+def btc_to_satoshis(amount: str) -> int:
+    return int(Decimal(amount) * SATOSHIS_PER_BTC)
+
+
+# Builds a zero-argument fetch() for repeated Binance balance lookups. The
+# keyed HMAC, headers and request paths are prepared once here instead of on
+# every call.
+def make_binance_signer(api_key, api_secret):
+    host = "api.binance.com"
+    headers = {"X-MBX-APIKEY": api_key}
+    sapi_headers = {**headers, "Content-Type": "application/x-www-form-urlencoded"}
+    sapi_path = "/sapi/v3/asset/getUserAsset"
+    account_prefix = "/api/v3/account?"
+
+    # Copying the keyed object skips re-hashing the padded secret for every
+    # signature.
+    hmac_template = hmac.new(api_secret.encode(), digestmod=hashlib.sha256)
+
+    def sign(query):
+        h = hmac_template.copy()
+        h.update(query.encode())
+        return f"{query}&signature={h.hexdigest()}"
+
+    def fetch():
+        ts = int(time.time() * 1000)
+
+        # getUserAsset filters to the BTC row server-side instead of
+        # returning every asset on the account. Keys without the SAPI
+        # permission are rejected there with 401/403 and fall back to the
+        # full account snapshot. Other errors, including rate limits (429)
+        # and IP bans (418), are not retried against the same host.
+        try:
+            data = json_loads(http_request(
+                host,
+                sapi_path,
+                sapi_headers,
+                method="POST",
+                body=sign(urlencode({"asset": "BTC", "timestamp": ts})).encode()
+            ))
+            return sum(
+                btc_to_satoshis(a["free"]) + btc_to_satoshis(a["locked"])
+                for a in data if a["asset"] == "BTC"
+            )
+        except urllib.error.HTTPError as e:
+            if e.code not in (401, 403):
+                report_error(f"Error fetching Binance balance: {e}")
+                return 0
+        except Exception as e:
+            report_error(f"Error fetching Binance balance: {e}")
+            return 0
+
+        path = account_prefix + sign(urlencode({"timestamp": ts}))
+
+        try:
+            data = json_loads(http_request(host, path, headers))
+            by_asset = {a["asset"]: a for a in data["balances"]}
+            b = by_asset.get("BTC")
+            if not b:
+                return 0
+            return btc_to_satoshis(b["free"]) + btc_to_satoshis(b["locked"])
+        except Exception as e:
+            report_error(f"Error fetching Binance balance: {e}")
+            return 0
+
+    return fetch
+
+
+# ((api_key, api_secret), fetch) for the most recently used key pair, so
+# repeated lookups reuse the prepared signer instead of rebuilding it.
+_binance_signer = None
+
+
+def fetch_binance_spot_balance(api_key, api_secret):
+    global _binance_signer
+    if _binance_signer is None or _binance_signer[0] != (api_key, api_secret):
+        _binance_signer = (
+            (api_key, api_secret),
+            make_binance_signer(api_key, api_secret)
+        )
+    return _binance_signer[1]()
 
 
 # =====================================================
@@ -134,6 +549,8 @@ def setup_config():
     api_key = input("Binance API Key: ").strip()
     api_secret = input("Binance API Secret: ").strip()
 
+    import getpass
+
     password = getpass.getpass("Create encryption password: ")
     confirm = getpass.getpass("Confirm password: ")
 
@@ -156,9 +573,14 @@ def load_config():
     if not os.path.exists(CONFIG_FILE):
         return setup_config()
 
+    import getpass
+
     password = getpass.getpass("Enter config password: ")
     try:
         return decrypt_config(password)
+    except ImportError:
+        print("This config needs argon2-cffi: pip install argon2-cffi")
+        exit(1)
     except Exception:
         print("Invalid password or corrupted config.")
         exit(1)
@@ -175,6 +597,7 @@ def main():
                         help="Decrypt and display config")
     args = parser.parse_args()
 
+    check_crypto_backend()
     config = load_config()
 
     if args.show_config:
@@ -183,7 +606,11 @@ def main():
 
     print("\n=== BTC Tracker ===\n")
 
+    addresses = config["btc_addresses"]
+
     # PRICE
+    # Fetched before anything else so a failure exits without sending the
+    # signed Binance request or touching the balance cache.
     if args.assume_price:
         price_usd = args.assume_price
         price_eur = price_usd * EUR_RATE
@@ -198,23 +625,43 @@ def main():
 
         print(f"BTC Price: USD {price_usd:,.2f} | EUR {price_eur:,.2f}\n")
 
-    total_btc_addresses = 0
-
-    print("=== BTC Address Balances ===")
-    for addr in config["btc_addresses"]:
-        bal = fetch_btc_address_balance(addr)
-        total_btc_addresses += bal
-        print(f"{addr}: {bal:.8f} BTC | USD {bal * price_usd:.2f} | EUR {bal * price_eur:.2f}")
-
-    print("\n=== Binance BTC Spot Balance ===")
-    spot_btc = fetch_binance_spot_balance(
-        config["binance_api_key"],
-        config["binance_api_secret"]
-    )
+    # The balance lookups are network-bound and hit different hosts, so run
+    # them side by side instead of one after another.
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        spot_future = pool.submit(
+            fetch_binance_spot_balance,
+            config["binance_api_key"],
+            config["binance_api_secret"]
+        )
+        balances_future = pool.submit(
+            fetch_cached_btc_address_balances,
+            addresses,
+            balance_cache_key(config)
+        )
+
+        # Balances are integer satoshis; they are only converted to BTC for
+        # display.
+        total_sats_addresses = 0
+
+        # Collect the section and write it once instead of once per address.
+        lines = ["=== BTC Address Balances ==="]
+        balances = balances_future.result()
+        flush_errors()
+        for addr in addresses:
+            total_sats_addresses += balances[addr]
+            bal = balances[addr] / SATOSHIS_PER_BTC
+            lines.append(f"{addr}: {bal:.8f} BTC | USD {bal * price_usd:.2f} | EUR {bal * price_eur:.2f}")
+        print("\n".join(lines))
+
+        print("\n=== Binance BTC Spot Balance ===")
+        spot_sats = spot_future.result()
+        flush_errors()
+
+    spot_btc = spot_sats / SATOSHIS_PER_BTC
 
     print(f"Binance: {spot_btc:.8f} BTC | USD {spot_btc * price_usd:.2f} | EUR {spot_btc * price_eur:.2f}\n")
 
-    total_btc = total_btc_addresses + spot_btc
+    total_btc = (total_sats_addresses + spot_sats) / SATOSHIS_PER_BTC
 
     print("=== TOTAL BTC VALUE ===")
     print(f"TOTAL BTC: {total_btc:.8f}")
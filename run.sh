@@ -14,7 +14,7 @@ fi
 source "$VENV_DIR/bin/activate"
 
 pip install --upgrade pip >/dev/null
-pip install cryptography >/dev/null
+pip install cryptography argon2-cffi >/dev/null
 
 python "$REPO_DIR/btc_tracker.py" "$@"
 